@@ -1,12 +1,18 @@
 import re
+from functools import lru_cache
 import streamlit as st
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from io import BytesIO
+from openpyxl import Workbook
 
 # ✅ 비밀번호 엑셀(스마트스토어) 복호화
 import msoffcrypto
 
+# ✅ 헤더 유사도 매칭 (build_mapping 3단계)
+from rapidfuzz import fuzz, process
+
 st.set_page_config(page_title="주문파일 → 송장파일 변환", layout="centered")
 st.title("📦 주문파일 → 송장 출력용 파일 변환기 (자동 플랫폼 판별 + 다중 업로드 통합)")
 
@@ -41,58 +47,126 @@ DEFAULT_TEMPLATE_COLUMNS = [
     "운송장번호",
 ]
 
-def build_default_template_df() -> pd.DataFrame:
-    return pd.DataFrame(columns=DEFAULT_TEMPLATE_COLUMNS)
-
 # -------------------------
 # 유틸: 컬럼명 정규화/검색
 # -------------------------
+_WS_RE = re.compile(r"\s+")
+_PUNCT_RE = re.compile(r"[()\-_/.,·:]")
+
+@lru_cache(maxsize=4096)
 def norm(s: str) -> str:
     if s is None:
         return ""
     s = str(s).strip().lower()
-    s = re.sub(r"\s+", "", s)
-    s = re.sub(r"[()\-_/.,·:]", "", s)
+    s = _WS_RE.sub("", s)
+    s = _PUNCT_RE.sub("", s)
     return s
 
-def find_col(df: pd.DataFrame, candidates: list[str]):
+def build_norm_cols(df: pd.DataFrame) -> dict:
+    """{정규화된 컬럼명: 원본 컬럼명} - 파일당 1회 계산해서 find_col 에 재사용"""
+    return {norm(c): c for c in df.columns}
+
+def find_col(df: pd.DataFrame, candidates: list[str], norm_cols: dict | None = None):
     """df에서 candidates(후보 헤더명) 중 하나라도 일치/포함되면 해당 컬럼명 반환"""
-    norm_cols = {norm(c): c for c in df.columns}
+    if norm_cols is None:
+        norm_cols = build_norm_cols(df)
+    return find_norm_col(norm_cols, tuple(norm(c) for c in candidates))
 
+@lru_cache(maxsize=256)
+def containment_matcher(norm_candidates: tuple):
+    """
+    부분 포함 판정을 후보 수와 무관하게 컬럼당 2회 검색으로 처리
+    - 후보 ⊂ 컬럼명: 후보 전체를 OR 로 묶은 정규식 1개로 search
+    - 컬럼명 ⊂ 후보: 후보들을 구분자(\0)로 이어붙인 문자열에서 in 검색
+    """
+    cands = [nc for nc in norm_candidates if nc]
+    if not cands:
+        return None
+    pattern = re.compile("|".join(map(re.escape, cands)))
+    joined = "\0".join(cands)
+    return pattern, joined
+
+def find_norm_col(norm_cols: dict, norm_candidates: tuple):
+    """find_col 과 동일하되, 정규화된 컬럼 dict(build_norm_cols)와 정규화된 후보 목록을 받음"""
     # 1) 완전 일치
-    for cand in candidates:
-        nc = norm(cand)
-        if nc in norm_cols:
-            return norm_cols[nc]
-
-    # 2) 부분 포함
+    for nc in norm_candidates:
+        hit = norm_cols.get(nc)
+        if hit is not None:
+            return hit
+
+    # 2) 부분 포함 (완전 일치 실패 시에만)
+    matcher = containment_matcher(norm_candidates)
+    if matcher is None:
+        return None
+    pattern, joined = matcher
     for df_norm, original in norm_cols.items():
-        for cand in candidates:
-            nc = norm(cand)
-            if nc and (nc in df_norm or df_norm in nc):
-                return original
+        if pattern.search(df_norm) or df_norm in joined:
+            return original
 
     return None
 
+# ✅ 헤더 유사도 매칭 컷오프
+# - 짧은 한글 헤더는 한 글자 차이도 80~86점 (수취인연락처1/2, 결제액/결제금액) → 컷오프는 90
+FUZZY_SCORE_CUTOFF = 90
+
+def fuzzy_norm_col(norm_cols: dict, norm_candidates: tuple):
+    """
+    후보 × 컬럼 유사도 행렬(process.cdist)을 한 번에 계산해 최고점 컬럼 반환
+    - 정규화(공백 제거)된 헤더끼리 비교하므로 토큰 단위가 아닌 문자열 전체 유사도(fuzz.ratio) 사용
+    - 점수가 FUZZY_SCORE_CUTOFF 미만이면 None
+    - 동점이면 후보 순서 → 컬럼 순서 우선
+    """
+    cands = [nc for nc in norm_candidates if nc]
+    if not cands or not norm_cols:
+        return None
+    col_norms = list(norm_cols)
+    scores = process.cdist(cands, col_norms, scorer=fuzz.ratio, score_cutoff=FUZZY_SCORE_CUTOFF)
+    if not scores.any():
+        return None
+    _, j = np.unravel_index(scores.argmax(), scores.shape)
+    return norm_cols[col_norms[j]]
+
 def clean_series(s: pd.Series) -> pd.Series:
-    return (
-        s.astype(str)
-        .fillna("")
-        .replace(["nan", "None"], "", regex=False)
-        .str.strip()
-    )
+    # 결측은 bitmap(StringDtype)으로 처리 → "nan"/"None" 문자열 치환 패스 불필요
+    return s.where(s.notna(), "").astype("string").str.strip()
+
+# 정리가 필요한 공백: 2칸 이상 연속 또는 탭/개행 등 일반 공백(" ") 이외의 공백 문자
+_WS_RUN_RE = re.compile(r"\s{2,}|[^\S ]")
+
+def collapse_ws(s: pd.Series) -> pd.Series:
+    """연속 공백을 1칸으로 접고 양끝 공백 제거 (접을 공백이 없으면 정규식 치환 생략)"""
+    if s.str.contains(_WS_RUN_RE).any():
+        s = s.str.replace(_WS_RE, " ", regex=True)
+    return s.str.strip()
+
+def clean_col(df: pd.DataFrame, col, cache: dict | None = None) -> pd.Series:
+    """df[col] 을 clean_series 처리. cache 를 넘기면 같은 컬럼은 1회만 정리"""
+    if cache is None:
+        return clean_series(df[col])
+    if col not in cache:
+        cache[col] = clean_series(df[col])
+    return cache[col]
 
 # =========================
 # ✅ 스마트스토어 암호(1234) 복호화 + 1행 제거(=header=1)
 # =========================
 SMARTSTORE_PASSWORD = "1234"
 
+# 암호화된 xlsx 는 OLE 복합문서, 일반 xlsx 는 ZIP 컨테이너
+OLE_MAGIC = b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"
+
+def is_ole_file(file_bytes: bytes) -> bool:
+    return file_bytes[:8] == OLE_MAGIC
+
 def decrypt_xlsx_if_needed(file_bytes: bytes, password: str) -> BytesIO:
     """
     암호화된 xlsx면 복호화해서 BytesIO 반환.
     암호화가 아니면 원본 BytesIO 반환.
+    - 매직 바이트로 먼저 판별 → 일반 xlsx(ZIP)는 msoffcrypto 를 거치지 않음
     """
     bio = BytesIO(file_bytes)
+    if not is_ole_file(file_bytes):
+        return bio
     try:
         office = msoffcrypto.OfficeFile(bio)
         office.load_key(password=password)
@@ -104,19 +178,18 @@ def decrypt_xlsx_if_needed(file_bytes: bytes, password: str) -> BytesIO:
         bio.seek(0)
         return bio
 
-def read_excel_safely(uploaded_file, platform_hint: str | None = None) -> pd.DataFrame:
+def read_excel_safely(file_bytes: bytes, platform_hint: str | None = None) -> pd.DataFrame:
     """
     - smartstore: 비번 1234 복호화 + 첫 번째 행 제거 후(header=1) 로드
     - others: 일반 로드
+    - 모든 셀을 문자열로 로드(dtype=str, keep_default_na=False) → dtype 추론/NaN 변환 생략
     """
-    file_bytes = uploaded_file.getvalue()
-
     if platform_hint == "smartstore":
         decrypted = decrypt_xlsx_if_needed(file_bytes, SMARTSTORE_PASSWORD)
         # ✅ 첫 번째 행 삭제 후 컬럼 매칭(2번째 행을 헤더로)
-        return pd.read_excel(decrypted, header=1, dtype=str)
+        return pd.read_excel(decrypted, header=1, engine="openpyxl", dtype=str, keep_default_na=False)
 
-    return pd.read_excel(BytesIO(file_bytes), dtype=str)
+    return pd.read_excel(BytesIO(file_bytes), engine="openpyxl", dtype=str, keep_default_na=False)
 
 # -------------------------
 # 플랫폼 판별
@@ -135,9 +208,20 @@ PLATFORM_SIGNATURES = {
     ],
 }
 
+# ✅ 해당 플랫폼에만 있는 헤더 - 정확히 1개 플랫폼만 걸리면 점수 계산 없이 바로 판별
+UNIQUE_SIGNATURES = {
+    "smartstore": {norm("상품주문번호")},
+    "coupang": {norm("노출상품명"), norm("노출상품명(옵션명)")},
+    "thirtymall": {norm("쇼핑몰구분")},
+}
+
 def detect_platform(df: pd.DataFrame) -> str:
     cols_norm = set(norm(c) for c in df.columns)
 
+    unique_hits = [p for p, keys in UNIQUE_SIGNATURES.items() if not keys.isdisjoint(cols_norm)]
+    if len(unique_hits) == 1:
+        return unique_hits[0]
+
     def score(keys):
         s = 0
         for k in keys:
@@ -156,7 +240,11 @@ def detect_platform(df: pd.DataFrame) -> str:
     thirty_score = score(PLATFORM_SIGNATURES["thirtymall"])
 
     # ✅ 떠리몰 파일은 '쇼핑몰구분' 값에 "떠리몰"/"thirtymall"이 들어오는 케이스가 많아서 값 기반 보정
-    mall_col = find_col(df, ["쇼핑몰구분", "쇼핑몰", "mall", "shop"])
+    # (+3 보정으로 판별 결과가 바뀔 수 있을 때만 컬럼 값을 스캔)
+    best_other = max(coupang_score, smart_score)
+    mall_col = None
+    if thirty_score <= best_other < thirty_score + 3:
+        mall_col = find_col(df, ["쇼핑몰구분", "쇼핑몰", "mall", "shop"])
     if mall_col is not None:
         vals = clean_series(df[mall_col]).str.lower()
         if (vals.str.contains("떠리몰", na=False) | vals.str.contains("thirtymall", na=False)).any():
@@ -226,91 +314,123 @@ CANDIDATES = {
     },
 }
 
+# ✅ 정적 후보 목록은 import 시 1회만 정규화
+NORM_CANDIDATES = {
+    invoice_col: {plat: tuple(norm(c) for c in cands) for plat, cands in p_dict.items()}
+    for invoice_col, p_dict in CANDIDATES.items()
+}
+
+# 플랫폼 판별 실패(unknown) 시 사용: smartstore → coupang → thirtymall 순서 유지한 합집합
+ALL_NORM_CANDIDATES = {
+    invoice_col: tuple(dict.fromkeys(
+        nc for plat in ("smartstore", "coupang", "thirtymall") for nc in p_dict.get(plat, ())
+    ))
+    for invoice_col, p_dict in NORM_CANDIDATES.items()
+}
+
 def build_mapping(df: pd.DataFrame, platform: str):
+    """
+    송장 컬럼 전체를 한 번에 매핑 (필드별 결과는 find_norm_col 과 동일)
+    - 1) 모든 필드의 완전 일치를 dict 조회로 먼저 처리
+    - 2) 남은 필드만 모아서 컬럼 목록을 1회 순회하며 부분 포함 판정
+    - 3) 그래도 없으면 유사도 매칭 (FUZZY_SCORE_CUTOFF 이상만)
+    """
+    norm_cols = build_norm_cols(df)
+    field_cands = {}
     mapping = {}
-    for invoice_col, p_dict in CANDIDATES.items():
+    pending = {}
+
+    # 1) 완전 일치
+    for invoice_col, p_dict in NORM_CANDIDATES.items():
         if platform == "unknown":
-            col = (
-                find_col(df, p_dict.get("smartstore", []))
-                or find_col(df, p_dict.get("coupang", []))
-                or find_col(df, p_dict.get("thirtymall", []))
-            )
+            cands = ALL_NORM_CANDIDATES[invoice_col]
         else:
-            col = find_col(df, p_dict.get(platform, []))
-        mapping[invoice_col] = col
+            cands = p_dict.get(platform, ())
+        field_cands[invoice_col] = cands
+        mapping[invoice_col] = next((norm_cols[nc] for nc in cands if nc in norm_cols), None)
+        if mapping[invoice_col] is None:
+            matcher = containment_matcher(cands)
+            if matcher is not None:
+                pending[invoice_col] = matcher
+
+    # 2) 부분 포함 (미해결 필드만)
+    for df_norm, original in norm_cols.items():
+        if not pending:
+            break
+        hits = [
+            invoice_col for invoice_col, (pattern, joined) in pending.items()
+            if pattern.search(df_norm) or df_norm in joined
+        ]
+        for invoice_col in hits:
+            mapping[invoice_col] = original
+            del pending[invoice_col]
+
+    # 3) 유사도 (여기까지 못 찾은 필드만)
+    for invoice_col, col in mapping.items():
+        if col is None:
+            mapping[invoice_col] = fuzzy_norm_col(norm_cols, field_cands[invoice_col])
+
     return mapping
 
 # -------------------------
 # ✅ 스마트스토어 품목명 결합 (Q열 + S열 옵션정보)
 # -------------------------
-def build_smartstore_item_name(order_df: pd.DataFrame) -> pd.Series:
-    product_col = find_col(order_df, ["상품명", "주문상품명", "상품명(옵션포함)", "상품명/옵션"])
-    option_col = find_col(order_df, ["옵션정보", "옵션", "옵션명", "옵션내용"])
+def build_smartstore_item_name(order_df: pd.DataFrame, cache: dict | None = None, norm_cols: dict | None = None) -> pd.Series:
+    product_col = find_col(order_df, ["상품명", "주문상품명", "상품명(옵션포함)", "상품명/옵션"], norm_cols)
+    option_col = find_col(order_df, ["옵션정보", "옵션", "옵션명", "옵션내용"], norm_cols)
 
     if product_col is not None:
-        product = clean_series(order_df[product_col])
+        product = clean_col(order_df, product_col, cache)
     else:
-        product = clean_series(order_df.iloc[:, 16]) if order_df.shape[1] > 16 else pd.Series([""] * len(order_df))
+        product = clean_col(order_df, order_df.columns[16], cache) if order_df.shape[1] > 16 else pd.Series([""] * len(order_df))
 
     if option_col is not None:
-        option = clean_series(order_df[option_col])
+        option = clean_col(order_df, option_col, cache)
     else:
-        option = clean_series(order_df.iloc[:, 18]) if order_df.shape[1] > 18 else pd.Series([""] * len(order_df))
+        option = clean_col(order_df, order_df.columns[18], cache) if order_df.shape[1] > 18 else pd.Series([""] * len(order_df))
 
-    combined = (product + " " + option).str.replace(r"\s+", " ", regex=True).str.strip()
-    return combined
+    return collapse_ws(product.str.cat(option, sep=" "))
 
 # -------------------------
 # ✅ 쿠팡 품목명: M열 노출상품명(옵션명)
 # -------------------------
-def build_coupang_item_name(order_df: pd.DataFrame) -> pd.Series:
-    col = find_col(order_df, ["노출상품명(옵션명)", "노출상품명", "노출 상품명(옵션명)", "노출 상품명"])
+def build_coupang_item_name(order_df: pd.DataFrame, cache: dict | None = None, norm_cols: dict | None = None) -> pd.Series:
+    col = find_col(order_df, ["노출상품명(옵션명)", "노출상품명", "노출 상품명(옵션명)", "노출 상품명"], norm_cols)
     if col is not None:
-        return clean_series(order_df[col])
+        return clean_col(order_df, col, cache)
     if order_df.shape[1] > 12:
-        return clean_series(order_df.iloc[:, 12])  # M열 fallback
+        return clean_col(order_df, order_df.columns[12], cache)  # M열 fallback
     return pd.Series([""] * len(order_df))
 
 # -------------------------
 # ✅ thirtymall(떠리몰) 품목명: S열 + V열 (중복 글 1회 표기)
 # -------------------------
+def merge_tokens(x: str, y: str) -> str:
+    """단어(공백 기준) 중복 제거 결합 - dict.fromkeys 로 순서 유지"""
+    return " ".join(dict.fromkeys((x + " " + y).split()))
+
 def dedupe_merge_text(a: pd.Series, b: pd.Series) -> pd.Series:
-    a = clean_series(a)
-    b = clean_series(b)
-
-    def merge_one(x, y):
-        x = (x or "").strip()
-        y = (y or "").strip()
-        if not x and not y:
-            return ""
-        if not x:
-            return y
-        if not y:
-            return x
-
-        # 완전 동일/포함 관계면 하나만
-        if x == y:
-            return x
-        if x in y:
-            return y
-        if y in x:
-            return x
-
-        # 단어(공백 기준) 중복 제거 결합
-        tokens = []
-        seen = set()
-        for t in (x + " " + y).split():
-            if t not in seen:
-                seen.add(t)
-                tokens.append(t)
-        return " ".join(tokens)
-
-    return pd.Series([merge_one(x, y) for x, y in zip(a.tolist(), b.tolist())])
-
-def build_thirtymall_item_name(order_df: pd.DataFrame) -> pd.Series:
+    """
+    두 텍스트 컬럼을 행 단위로 결합 (중복 글 1회 표기)
+    - 한쪽이 비었거나 동일/포함 관계면 긴 쪽 하나만
+    - 그 외에는 단어(공백 기준) 중복 제거 결합
+    - 값은 object 배열 그대로 비교 (고정폭 <U 배열로 변환하지 않음 → 긴 셀 1개로 메모리가 폭증하지 않음)
+    """
+    x = clean_series(a).to_numpy(dtype=object)
+    y = clean_series(b).to_numpy(dtype=object)
+
+    # 한 번의 순회로 판정: 빈 문자열은 항상 포함 관계 → "한쪽만 있음" 도 포함 분기에서 처리
+    # 토큰 결합은 어느 쪽에도 포함되지 않는 행에서만 실행
+    result = [
+        yy if xx in yy else xx if yy in xx else merge_tokens(xx, yy)
+        for xx, yy in zip(x, y)
+    ]
+    return pd.Series(result, index=a.index, dtype=object)
+
+def build_thirtymall_item_name(order_df: pd.DataFrame, norm_cols: dict | None = None) -> pd.Series:
     # 헤더 기반(우선)
-    s_col = find_col(order_df, ["상품명"])
-    v_col = find_col(order_df, ["옵션명:옵션값", "옵션정보", "옵션", "옵션명"])
+    s_col = find_col(order_df, ["상품명"], norm_cols)
+    v_col = find_col(order_df, ["옵션명:옵션값", "옵션정보", "옵션", "옵션명"], norm_cols)
 
     if s_col is not None:
         s = order_df[s_col]
@@ -327,83 +447,158 @@ def build_thirtymall_item_name(order_df: pd.DataFrame) -> pd.Series:
 # -------------------------
 # ✅ thirtymall(떠리몰) 주문번호: H열(8번째 컬럼) 강제
 # -------------------------
-def build_thirtymall_order_no(order_df: pd.DataFrame) -> pd.Series:
+def build_thirtymall_order_no(order_df: pd.DataFrame, cache: dict | None = None) -> pd.Series:
     if order_df.shape[1] > 7:
-        return clean_series(order_df.iloc[:, 7])
+        return clean_col(order_df, order_df.columns[7], cache)
     return pd.Series([""] * len(order_df))
 
 # -------------------------
 # 스마트스토어 받는사람 보강(전화/우편/주소)
 # -------------------------
-def build_smartstore_phone(order_df: pd.DataFrame) -> pd.Series:
-    c1 = find_col(order_df, ["수취인연락처1", "수취인연락처(1)", "수취인 휴대전화", "수취인휴대전화"])
-    c2 = find_col(order_df, ["수취인연락처2", "수취인연락처(2)"])
-    c  = find_col(order_df, ["수취인연락처", "수취인전화번호", "연락처", "휴대폰번호", "휴대전화"])
+def build_smartstore_phone(order_df: pd.DataFrame, cache: dict | None = None, norm_cols: dict | None = None) -> pd.Series:
+    c1 = find_col(order_df, ["수취인연락처1", "수취인연락처(1)", "수취인 휴대전화", "수취인휴대전화"], norm_cols)
+    c2 = find_col(order_df, ["수취인연락처2", "수취인연락처(2)"], norm_cols)
+    c  = find_col(order_df, ["수취인연락처", "수취인전화번호", "연락처", "휴대폰번호", "휴대전화"], norm_cols)
 
     if c1 is not None:
-        return clean_series(order_df[c1])
+        return clean_col(order_df, c1, cache)
     if c2 is not None:
-        return clean_series(order_df[c2])
+        return clean_col(order_df, c2, cache)
     if c is not None:
-        return clean_series(order_df[c])
+        return clean_col(order_df, c, cache)
     return pd.Series([""] * len(order_df))
 
-def build_smartstore_zip(order_df: pd.DataFrame) -> pd.Series:
-    z = find_col(order_df, ["수취인우편번호", "우편번호", "배송지우편번호", "우편 번호"])
+def build_smartstore_zip(order_df: pd.DataFrame, cache: dict | None = None, norm_cols: dict | None = None) -> pd.Series:
+    z = find_col(order_df, ["수취인우편번호", "우편번호", "배송지우편번호", "우편 번호"], norm_cols)
     if z is None:
         return pd.Series([""] * len(order_df))
-    return clean_series(order_df[z])
+    return clean_col(order_df, z, cache)
 
-def build_smartstore_address(order_df: pd.DataFrame) -> pd.Series:
-    base = find_col(order_df, ["수취인기본주소", "기본주소", "도로명주소", "지번주소"])
-    detail = find_col(order_df, ["수취인상세주소", "상세주소", "상세 주소"])
+def build_smartstore_address(order_df: pd.DataFrame, cache: dict | None = None, norm_cols: dict | None = None) -> pd.Series:
+    base = find_col(order_df, ["수취인기본주소", "기본주소", "도로명주소", "지번주소"], norm_cols)
+    detail = find_col(order_df, ["수취인상세주소", "상세주소", "상세 주소"], norm_cols)
 
     if base is not None:
-        base_s = clean_series(order_df[base])
+        base_s = clean_col(order_df, base, cache)
         if detail is not None:
-            detail_s = clean_series(order_df[detail])
-            return (base_s + " " + detail_s).str.replace(r"\s+", " ", regex=True).str.strip()
+            detail_s = clean_col(order_df, detail, cache)
+            return collapse_ws(base_s.str.cat(detail_s, sep=" "))
         return base_s
 
-    addr = find_col(order_df, ["수취인주소", "배송지주소", "배송지", "주소"])
+    addr = find_col(order_df, ["수취인주소", "배송지주소", "배송지", "주소"], norm_cols)
     if addr is None:
         return pd.Series([""] * len(order_df))
-    return clean_series(order_df[addr])
+    return clean_col(order_df, addr, cache)
 
 # -------------------------
 # 송장 행 생성
 # -------------------------
 def make_invoice_rows(template_columns: list[str], order_df: pd.DataFrame, mapping: dict, platform: str) -> pd.DataFrame:
-    out = pd.DataFrame({c: [""] * len(order_df) for c in template_columns})
+    # 컬럼별 배열(dict)을 먼저 채운 뒤 DataFrame 은 마지막에 1회만 생성
+    targets = set(template_columns)
+    data = {}
 
     # 기본 매핑
     for inv_col, ord_col in mapping.items():
-        if inv_col in out.columns and ord_col is not None and ord_col in order_df.columns:
-            out[inv_col] = order_df[ord_col]
+        if inv_col in targets and ord_col is not None and ord_col in order_df.columns:
+            data[inv_col] = order_df[ord_col].to_numpy()
+
+    # 같은 원본 컬럼을 여러 규칙이 참조해도 clean_series 는 1회만
+    cleaned = {}
+    # 헤더 정규화 dict 도 파일당 1회만 만들어 모든 규칙의 find_col 에 재사용
+    norm_cols = build_norm_cols(order_df)
 
     # 플랫폼별 품목명 강제 규칙 적용
-    if "품목명" in out.columns:
+    if "품목명" in targets:
         if platform == "smartstore":
-            out["품목명"] = build_smartstore_item_name(order_df)
+            data["품목명"] = build_smartstore_item_name(order_df, cleaned, norm_cols).to_numpy()
         elif platform == "coupang":
-            out["품목명"] = build_coupang_item_name(order_df)
+            data["품목명"] = build_coupang_item_name(order_df, cleaned, norm_cols).to_numpy()
         elif platform == "thirtymall":
-            out["품목명"] = build_thirtymall_item_name(order_df)
+            data["품목명"] = build_thirtymall_item_name(order_df, norm_cols).to_numpy()
 
     # 떠리몰 주문번호는 H열 강제 사용
-    if platform == "thirtymall" and "고객주문번호" in out.columns:
-        out["고객주문번호"] = build_thirtymall_order_no(order_df)
+    if platform == "thirtymall" and "고객주문번호" in targets:
+        data["고객주문번호"] = build_thirtymall_order_no(order_df, cleaned).to_numpy()
 
     # 스마트스토어 받는사람 정보 강제 세팅(분리 컬럼 조합 포함)
     if platform == "smartstore":
-        if "받는분전화번호" in out.columns:
-            out["받는분전화번호"] = build_smartstore_phone(order_df)
-        if "받는분우편번호" in out.columns:
-            out["받는분우편번호"] = build_smartstore_zip(order_df)
-        if "받는분주소(전체,분할)" in out.columns:
-            out["받는분주소(전체,분할)"] = build_smartstore_address(order_df)
+        if "받는분전화번호" in targets:
+            data["받는분전화번호"] = build_smartstore_phone(order_df, cleaned, norm_cols).to_numpy()
+        if "받는분우편번호" in targets:
+            data["받는분우편번호"] = build_smartstore_zip(order_df, cleaned, norm_cols).to_numpy()
+        if "받는분주소(전체,분할)" in targets:
+            data["받는분주소(전체,분할)"] = build_smartstore_address(order_df, cleaned, norm_cols).to_numpy()
+
+    # 매핑되지 않은 컬럼은 빈 문자열 배열 하나를 공유
+    empty = np.full(len(order_df), "", dtype=object)
+    return pd.DataFrame({c: data.get(c, empty) for c in template_columns}, copy=False)
+
+# -------------------------
+# 주문파일 1개 처리 (판별 → 로드 → 매핑 → 송장 행)
+# -------------------------
+PLATFORM_LABEL = {
+    "coupang": "쿠팡",
+    "smartstore": "스마트스토어",
+    "thirtymall": "thirtymall(떠리몰)",
+    "unknown": "알수없음",
+}
 
-    return out
+# ✅ st.cache_data: 위젯 조작으로 스크립트가 재실행되어도 같은 파일(바이트 해시 기준)은 재계산하지 않음
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_order_df(file_bytes: bytes) -> tuple[str, pd.DataFrame]:
+    """주문파일 로드 + 플랫폼 판별 (파일당 1회 파싱) → (platform, order_df)"""
+    if is_ole_file(file_bytes):
+        # 암호화(OLE) 파일 => 스마트스토어 → 복호화+header=1로 로드 후 판별
+        order_df = read_excel_safely(file_bytes, platform_hint="smartstore")
+        return detect_platform(order_df), order_df
+
+    order_df = read_excel_safely(file_bytes, platform_hint=None)
+    platform = detect_platform(order_df)
+    # 암호 없는 스마트스토어 파일만 첫 번째 행 제거(header=1)로 다시 로드
+    if platform == "smartstore":
+        order_df = read_excel_safely(file_bytes, platform_hint="smartstore")
+    return platform, order_df
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_invoice(file_bytes: bytes, template_columns: tuple) -> tuple[pd.DataFrame, str, int, int, int]:
+    """주문파일 1개 → (송장 행, platform, 매핑 성공 수, 매핑 대상 수, 주문 행 수)"""
+    platform, order_df = load_order_df(file_bytes)
+    mapping = build_mapping(order_df, platform)
+    out_rows = make_invoice_rows(list(template_columns), order_df, mapping, platform)
+    ok_cnt = sum(1 for v in mapping.values() if v is not None)
+    return out_rows, platform, ok_cnt, len(mapping), len(order_df)
+
+def process_order_file(uf, template_columns: list[str]) -> tuple[pd.DataFrame, dict]:
+    # 캐시 키는 파일 내용(바이트)만 사용 → 파일명이 달라도 같은 내용이면 캐시 적중
+    out_rows, platform, ok_cnt, total_cnt, order_cnt = build_invoice(uf.getvalue(), tuple(template_columns))
+    report_row = {
+        "파일명": uf.name,
+        "자동판별 플랫폼": PLATFORM_LABEL.get(platform, "알수없음"),
+        "매핑 성공(참고)": f"{ok_cnt}/{total_cnt}",
+        "행(주문) 수": order_cnt,
+    }
+    return out_rows, report_row
+
+# -------------------------
+# 송장 파일 쓰기
+# -------------------------
+def write_invoice_xlsx(template_columns: list[str], frames: list[pd.DataFrame]) -> BytesIO:
+    """
+    파일별 송장 행(frames)을 한 시트에 이어서 기록한 xlsx 반환
+    - openpyxl write_only 모드: 셀 객체를 메모리에 쌓지 않고 행 단위로 XML 스트리밍
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(list(template_columns))
+    for frame in frames:
+        for row in frame.itertuples(index=False, name=None):
+            ws.append(row)
+
+    buffer = BytesIO()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
 
 # =========================
 # UI: 템플릿 선택
@@ -424,55 +619,22 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
-platform_label = {
-    "coupang": "쿠팡",
-    "smartstore": "스마트스토어",
-    "thirtymall": "thirtymall(떠리몰)",
-    "unknown": "알수없음",
-}
-
 if uploaded_files:
     try:
         # 템플릿 로드
         if template_upload is not None:
-            template_df = pd.read_excel(template_upload)
-            template_columns = list(template_df.columns)
+            # 헤더(컬럼명)만 필요 → 본문은 읽지 않음 (스트림 위치와 무관하게 bytes 로 읽음)
+            template_columns = list(pd.read_excel(BytesIO(template_upload.getvalue()), nrows=0).columns)
         else:
-            template_df = build_default_template_df()
             template_columns = DEFAULT_TEMPLATE_COLUMNS
 
-        all_out_rows = []
-        report_rows = []
-
-        for uf in uploaded_files:
-            # 1) 플랫폼 판별 (스마트스토어는 암호 때문에 일반 로드 실패할 수 있음)
-            try:
-                tmp_df = read_excel_safely(uf, platform_hint=None)
-                platform = detect_platform(tmp_df)
-            except Exception:
-                # 일반 로드 실패 => 스마트스토어 가능성이 높으므로 복호화+header=1로 로드 후 판별
-                tmp_df2 = read_excel_safely(uf, platform_hint="smartstore")
-                platform = detect_platform(tmp_df2)
-
-            # 2) 정식 로드
-            if platform == "smartstore":
-                order_df = read_excel_safely(uf, platform_hint="smartstore")
-            else:
-                order_df = read_excel_safely(uf, platform_hint=None)
-
-            mapping = build_mapping(order_df, platform)
-            out_rows = make_invoice_rows(template_columns, order_df, mapping, platform)
-            all_out_rows.append(out_rows)
+        results = [process_order_file(uf, template_columns) for uf in uploaded_files]
 
-            ok_cnt = sum(1 for v in mapping.values() if v is not None)
-            report_rows.append({
-                "파일명": uf.name,
-                "자동판별 플랫폼": platform_label.get(platform, "알수없음"),
-                "매핑 성공(참고)": f"{ok_cnt}/{len(mapping)}",
-                "행(주문) 수": len(order_df),
-            })
+        all_out_rows = [out_rows for out_rows, _ in results]
+        report_rows = [report_row for _, report_row in results]
 
-        merged_out = pd.concat(all_out_rows, ignore_index=True)
+        # 파일별 결과를 합치지(pd.concat) 않고 같은 시트에 이어서 기록
+        total_rows = sum(len(out_rows) for out_rows in all_out_rows)
 
         st.subheader("📌 파일별 자동 판별/변환 요약")
         st.dataframe(pd.DataFrame(report_rows), use_container_width=True)
@@ -480,12 +642,9 @@ if uploaded_files:
         now_str = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_filename = f"통합_송장파일_{now_str}.xlsx"
 
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            merged_out.to_excel(writer, index=False)
-        buffer.seek(0)
+        buffer = write_invoice_xlsx(template_columns, all_out_rows)
 
-        st.success(f"✅ 통합 송장파일 생성 완료! (총 {len(merged_out)}행)")
+        st.success(f"✅ 통합 송장파일 생성 완료! (총 {total_rows}행)")
         st.download_button(
             "📥 통합 송장파일 다운로드",
             data=buffer.getvalue(),
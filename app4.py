@@ -1,8 +1,11 @@
 import re
 import streamlit as st
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import date, datetime, time
 from io import BytesIO
+from openpyxl import Workbook
+from python_calamine import CalamineWorkbook
 
 st.set_page_config(page_title="주문파일 → 송장파일 변환", layout="centered")
 st.title("📦 주문파일 → 송장 출력용 파일 변환기 (자동 플랫폼 판별 + 다중 업로드 통합)")
@@ -36,9 +39,6 @@ DEFAULT_TEMPLATE_COLUMNS = [
     "운송장번호",
 ]
 
-def build_default_template_df() -> pd.DataFrame:
-    return pd.DataFrame(columns=DEFAULT_TEMPLATE_COLUMNS)
-
 # -------------------------
 # 유틸: 컬럼명 정규화/검색
 # -------------------------
@@ -77,6 +77,78 @@ def clean_series(s: pd.Series) -> pd.Series:
         .str.strip()
     )
 
+# -------------------------
+# 엑셀 읽기 (calamine)
+# -------------------------
+def make_header_names(raw_headers) -> list:
+    """
+    pd.read_excel 과 동일한 헤더명: 빈 칸은 'Unnamed: i', 중복은 '이름.1', '이름.2' ...
+    - 이름 있는 컬럼을 먼저, 빈 칸(Unnamed)은 나중에 처리 (pandas 와 같은 순서)
+    - 접미사를 붙인 이름이 이미 다른 헤더에 있으면 (예: a, a, a.1) 번호를 계속 올림 → 중복 라벨이 남지 않음
+    """
+    headers = [f"Unnamed: {i}" if h is None else h for i, h in enumerate(raw_headers)]
+    unnamed = [i for i, h in enumerate(raw_headers) if h is None]
+    named = [i for i, h in enumerate(raw_headers) if h is not None]
+
+    counts = {}
+    for i in named + unnamed:
+        col = base = headers[i]
+        cur = counts.get(col, 0)
+        while cur > 0:
+            counts[base] = cur + 1
+            col = f"{base}.{cur}"
+            cur = cur + 1 if col in headers else counts.get(col, 0)
+        headers[i] = col
+        counts[col] = cur + 1
+    return headers
+
+def _cell_value(v):
+    # calamine 은 빈 셀(공백만 있는 셀 포함)을 "" 로 주므로 None 으로 통일
+    if v == "":
+        return None
+    # pd.read_excel 과 동일하게 정수로 떨어지는 실수(3.0)는 int 로
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    # 날짜만 있는 셀은 calamine 이 date 로 줌 → pd.read_excel 과 동일하게 datetime(00:00) 으로
+    if type(v) is date:
+        return datetime.combine(v, time())
+    return v
+
+def read_sheet_rows(file, nrows: int | None = None) -> list[tuple]:
+    """첫 시트의 셀 값을 행 단위 tuple 로 읽기 (calamine: Rust 기반 네이티브 파서)"""
+    sheet = CalamineWorkbook.from_filelike(file).get_sheet_by_index(0)
+    rows = sheet.to_python(skip_empty_area=False, nrows=nrows)
+    return [tuple(_cell_value(v) for v in row) for row in rows]
+
+def read_orders_fast(file) -> pd.DataFrame:
+    """
+    주문 엑셀을 calamine 으로 읽어 DataFrame 생성
+    - 첫 행 = 헤더, 끝쪽의 완전히 빈 행/헤더 없는 빈 열은 제외 (pd.read_excel 과 동일)
+    """
+    rows = read_sheet_rows(file)
+    raw_headers = list(rows[0]) if rows else []
+    records = rows[1:]
+
+    while records and all(v is None for v in records[-1]):
+        records.pop()
+
+    width = len(raw_headers)
+    while width and raw_headers[width - 1] is None and all(
+        len(r) < width or r[width - 1] is None for r in records
+    ):
+        width -= 1
+
+    records = [r[:width] + (None,) * (width - len(r)) for r in records]
+    return pd.DataFrame.from_records(records, columns=make_header_names(raw_headers[:width]))
+
+def read_header_row(file) -> list:
+    """엑셀 첫 행(헤더)만 읽기 - 본문은 파싱하지 않음"""
+    rows = read_sheet_rows(file, nrows=1)
+    raw_headers = list(rows[0]) if rows else []
+    while raw_headers and raw_headers[-1] is None:
+        raw_headers.pop()
+    return make_header_names(raw_headers)
+
 # -------------------------
 # 플랫폼 판별
 # -------------------------
@@ -85,24 +157,31 @@ PLATFORM_SIGNATURES = {
     "smartstore": ["상품주문번호", "수취인명", "배송메시지", "배송메세지", "옵션정보", "우편번호"],
 }
 
+def _substrings(s: str) -> frozenset:
+    """s 의 모든 부분 문자열 (빈 문자열 포함)"""
+    return frozenset(s[i:j] for i in range(len(s) + 1) for j in range(i, len(s) + 1))
+
+# 시그니처는 고정값 → import 시 한 번만 정규화/부분 문자열 집합 생성
+NORM_SIGNATURES = {plat: tuple(norm(k) for k in keys) for plat, keys in PLATFORM_SIGNATURES.items()}
+SIGNATURE_SUBSTRINGS = {nk: _substrings(nk) for keys in NORM_SIGNATURES.values() for nk in keys}
+
 def detect_platform(df: pd.DataFrame) -> str:
     cols_norm = set(norm(c) for c in df.columns)
+    # 헤더 전체를 구분자(\0)로 이어붙여 시그니처당 1회 검색 (컬럼별 이중 루프 없음)
+    joined = "\0".join(cols_norm)
 
-    def score(keys):
+    def score(norm_keys):
         s = 0
-        for k in keys:
-            nk = norm(k)
+        for nk in norm_keys:
             if nk in cols_norm:
                 s += 2
-            else:
-                for c in cols_norm:
-                    if nk and (nk in c or c in nk):
-                        s += 1
-                        break
+            # 부분 포함: 시그니처 ⊂ 컬럼명 (joined 검색) 또는 컬럼명 ⊂ 시그니처 (부분 문자열 집합 교집합)
+            elif nk and (nk in joined or not cols_norm.isdisjoint(SIGNATURE_SUBSTRINGS[nk])):
+                s += 1
         return s
 
-    coupang_score = score(PLATFORM_SIGNATURES["coupang"])
-    smart_score = score(PLATFORM_SIGNATURES["smartstore"])
+    coupang_score = score(NORM_SIGNATURES["coupang"])
+    smart_score = score(NORM_SIGNATURES["smartstore"])
 
     if coupang_score == 0 and smart_score == 0:
         return "unknown"
@@ -159,15 +238,19 @@ CANDIDATES = {
     },
 }
 
-def build_mapping(df: pd.DataFrame, platform: str):
+def build_mapping(df: pd.DataFrame, platform: str) -> tuple[dict, int]:
+    """송장 필드별 주문 컬럼 매핑 → (mapping, 매핑 성공 수)"""
     mapping = {}
+    ok_cnt = 0
     for invoice_col, p_dict in CANDIDATES.items():
         if platform == "unknown":
             col = find_col(df, p_dict["smartstore"]) or find_col(df, p_dict["coupang"])
         else:
             col = find_col(df, p_dict[platform])
         mapping[invoice_col] = col
-    return mapping
+        if col is not None:
+            ok_cnt += 1
+    return mapping, ok_cnt
 
 # -------------------------
 # ✅ 스마트스토어 품목명 결합 (Q열 + S열 옵션정보)
@@ -254,31 +337,118 @@ def build_smartstore_address(order_df: pd.DataFrame) -> pd.Series:
 # -------------------------
 # 송장 행 생성
 # -------------------------
-def make_invoice_rows(template_columns: list[str], order_df: pd.DataFrame, mapping: dict, platform: str) -> pd.DataFrame:
-    out = pd.DataFrame({c: [""] * len(order_df) for c in template_columns})
+def make_invoice_rows(template_columns: tuple, order_df: pd.DataFrame, mapping: dict, platform: str) -> list[list]:
+    """송장 행 목록(list[list], template_columns 순서) 반환 - 여러 파일 결과는 extend 로 이어붙임"""
+    # 컬럼별 numpy 배열(dict)을 채운 뒤 한 번에 행으로 변환 (중간 DataFrame 없음)
+    n = len(order_df)
+    targets = set(template_columns)
+    data = {}
 
     # 기본 매핑
     for inv_col, ord_col in mapping.items():
-        if inv_col in out.columns and ord_col is not None and ord_col in order_df.columns:
-            out[inv_col] = order_df[ord_col]
+        if inv_col in targets and ord_col is not None and ord_col in order_df.columns:
+            data[inv_col] = order_df[ord_col].to_numpy(dtype=object)
 
     # ✅ 플랫폼별 품목명 강제 규칙 적용
-    if "품목명" in out.columns:
+    if "품목명" in targets:
         if platform == "smartstore":
-            out["품목명"] = build_smartstore_item_name(order_df)
+            data["품목명"] = build_smartstore_item_name(order_df).to_numpy(dtype=object)
         elif platform == "coupang":
-            out["품목명"] = build_coupang_item_name(order_df)
+            data["품목명"] = build_coupang_item_name(order_df).to_numpy(dtype=object)
 
     # ✅ 스마트스토어 받는사람 정보 강제 세팅(분리 컬럼 조합 포함)
     if platform == "smartstore":
-        if "받는분전화번호" in out.columns:
-            out["받는분전화번호"] = build_smartstore_phone(order_df)
-        if "받는분우편번호" in out.columns:
-            out["받는분우편번호"] = build_smartstore_zip(order_df)
-        if "받는분주소(전체,분할)" in out.columns:
-            out["받는분주소(전체,분할)"] = build_smartstore_address(order_df)
+        if "받는분전화번호" in targets:
+            data["받는분전화번호"] = build_smartstore_phone(order_df).to_numpy(dtype=object)
+        if "받는분우편번호" in targets:
+            data["받는분우편번호"] = build_smartstore_zip(order_df).to_numpy(dtype=object)
+        if "받는분주소(전체,분할)" in targets:
+            data["받는분주소(전체,분할)"] = build_smartstore_address(order_df).to_numpy(dtype=object)
+
+    if not template_columns:
+        return [[] for _ in range(n)]
+
+    # 매핑되지 않은 컬럼은 빈 문자열 배열 하나를 공유
+    empty = np.full(n, "", dtype=object)
+    table = np.column_stack([data.get(c, empty) for c in template_columns])
 
-    return out
+    # 결측(NaN)은 None 으로 → 엑셀에 빈 셀로 기록
+    table[pd.isna(table)] = None
+    return table.tolist()
+
+# -------------------------
+# 주문파일 1개 처리 (로드 → 판별 → 매핑 → 송장 행)
+# -------------------------
+@st.cache_data(show_spinner=False, max_entries=32)
+def parse_order_file(file_bytes: bytes, template_columns: tuple) -> tuple[list[list], str, int, int, int]:
+    """
+    주문파일 1개 → (송장 행, platform, 매핑 성공 수, 매핑 대상 수, 주문 행 수)
+    - 파일 내용(bytes) 기준 캐시: 업로드 목록이 바뀌어도 기존 파일은 재파싱하지 않음
+    """
+    order_df = read_orders_fast(BytesIO(file_bytes))
+
+    platform = detect_platform(order_df)
+    mapping, ok_cnt = build_mapping(order_df, platform)
+
+    out_rows = make_invoice_rows(template_columns, order_df, mapping, platform)
+    return out_rows, platform, ok_cnt, len(mapping), len(order_df)
+
+PLATFORM_LABEL = {
+    "coupang": "쿠팡",
+    "smartstore": "스마트스토어",
+}
+
+# 파일별 요약 행은 (파일명, 플랫폼, 매핑 성공, 행 수) 고정 스키마 tuple
+REPORT_COLUMNS = ["파일명", "자동판별 플랫폼", "매핑 성공(참고)", "행(주문) 수"]
+
+def process_order_file(file_name: str, file_bytes: bytes, template_columns: tuple) -> tuple[list[list], tuple]:
+    out_rows, platform, ok_cnt, total_cnt, order_cnt = parse_order_file(file_bytes, template_columns)
+    report_row = (file_name, PLATFORM_LABEL.get(platform, "알수없음"), f"{ok_cnt}/{total_cnt}", order_cnt)
+    return out_rows, report_row
+
+# -------------------------
+# 송장 파일 쓰기
+# -------------------------
+def write_invoice_xlsx(template_columns: tuple, rows: list[list]) -> bytes:
+    """
+    송장 행 목록을 xlsx 로 기록해 bytes 반환
+    - openpyxl write_only 모드: 셀 객체를 메모리에 쌓지 않고 행 단위로 XML 스트리밍
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(template_columns)
+    for row in rows:
+        ws.append(row)
+
+    buffer = BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+# -------------------------
+# 업로드 전체 → 통합 송장파일 (캐시)
+# -------------------------
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_invoice_file(files: tuple, template_columns: tuple) -> tuple[bytes, list[tuple], int]:
+    """
+    files = ((파일명, 파일 bytes), ...) → (xlsx bytes, 파일별 요약, 총 행 수)
+    - 위젯 조작으로 스크립트가 재실행되어도 같은 업로드/템플릿이면 파싱·엑셀 생성을 건너뜀
+    """
+    results = [process_order_file(f[0], f[1], template_columns) for f in files]
+
+    # 파일 1개면 이어붙일 필요 없이 그 행 목록을 그대로 사용 (st.cache_data 는 호출마다 복사본을 돌려줌)
+    if len(results) == 1:
+        all_out_rows = results[0][0]
+    else:
+        # 전체 행 수를 미리 알고 있으므로 한 번에 할당하고 구간별로 채움 (extend 재할당 없음)
+        all_out_rows = [None] * sum(len(out_rows) for out_rows, _ in results)
+        pos = 0
+        for out_rows, _ in results:
+            all_out_rows[pos:pos + len(out_rows)] = out_rows
+            pos += len(out_rows)
+    report_rows = [report_row for _, report_row in results]
+
+    # 전체 행 목록을 그대로 기록 (pd.concat / 통합 DataFrame 생성 없음)
+    return write_invoice_xlsx(template_columns, all_out_rows), report_rows, len(all_out_rows)
 
 # =========================
 # UI: 템플릿 선택
@@ -300,55 +470,37 @@ uploaded_files = st.file_uploader(
 )
 
 if uploaded_files:
-    try:
-        # 템플릿 로드
-        if template_upload is not None:
-            template_df = pd.read_excel(template_upload)
-            template_columns = list(template_df.columns)
-        else:
-            template_df = build_default_template_df()
-            template_columns = DEFAULT_TEMPLATE_COLUMNS
-
-        all_out_rows = []
-        report_rows = []
-
-        for uf in uploaded_files:
-            order_df = pd.read_excel(uf)
-
-            platform = detect_platform(order_df)
-            mapping = build_mapping(order_df, platform)
-
-            out_rows = make_invoice_rows(template_columns, order_df, mapping, platform)
-            all_out_rows.append(out_rows)
-
-            ok_cnt = sum(1 for v in mapping.values() if v is not None)
-            report_rows.append({
-                "파일명": uf.name,
-                "자동판별 플랫폼": "쿠팡" if platform == "coupang" else ("스마트스토어" if platform == "smartstore" else "알수없음"),
-                "매핑 성공(참고)": f"{ok_cnt}/{len(mapping)}",
-                "행(주문) 수": len(order_df),
-            })
-
-        merged_out = pd.concat(all_out_rows, ignore_index=True)
-
-        st.subheader("📌 파일별 자동 판별/변환 요약")
-        st.dataframe(pd.DataFrame(report_rows), use_container_width=True)
-
-        now_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"통합_송장파일_{now_str}.xlsx"
-
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            merged_out.to_excel(writer, index=False)
-        buffer.seek(0)
-
-        st.success(f"✅ 통합 송장파일 생성 완료! (총 {len(merged_out)}행)")
-        st.download_button(
-            "📥 통합 송장파일 다운로드",
-            data=buffer.getvalue(),
-            file_name=output_filename,
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-
-    except Exception as e:
-        st.error(f"❌ 오류 발생: {e}")
+    # 업로드/템플릿을 조정하는 재실행마다 만들지 않고, 버튼을 눌렀을 때만 송장파일 생성
+    # (같은 업로드/템플릿이면 build_invoice_file 캐시로 다시 눌러도 즉시 반환)
+    if st.button("통합 송장파일 생성"):
+        try:
+            # 템플릿 로드 (캐시 키로 쓰이므로 한 번만 tuple 로 변환해 그대로 전달)
+            if template_upload is not None:
+                # getvalue(): 스트림 위치와 무관하게 업로드 bytes 를 그대로 사용 (read/seek 불필요)
+                template_columns = tuple(read_header_row(BytesIO(template_upload.getvalue())))
+            else:
+                template_columns = tuple(DEFAULT_TEMPLATE_COLUMNS)
+
+            xlsx_bytes, report_rows, total_rows = build_invoice_file(
+                tuple((uf.name, uf.getvalue()) for uf in uploaded_files),
+                template_columns,
+            )
+
+            st.subheader("📌 파일별 자동 판별/변환 요약")
+            st.table(pd.DataFrame.from_records(report_rows, columns=REPORT_COLUMNS))
+
+            st.success(f"✅ 통합 송장파일 생성 완료! (총 {total_rows}행)")
+
+            # 파일명 시각은 캐시 밖, 다운로드 버튼 직전에 계산 (캐시된 결과라도 항상 현재 시각)
+            now_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_filename = f"통합_송장파일_{now_str}.xlsx"
+            st.download_button(
+                "📥 통합 송장파일 다운로드",
+                data=xlsx_bytes,
+                file_name=output_filename,
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore",  # 다운로드 클릭으로 스크립트가 재실행되어 결과가 사라지지 않도록
+            )
+
+        except Exception as e:
+            st.error(f"❌ 오류 발생: {e}")